@@ -0,0 +1,148 @@
+"""Compare requests/second of the dev server against the gunicorn setup.
+
+Starts each server in turn, drives it with keep-alive HTTP/1.1 clients spread
+over several processes, and prints the throughput:
+
+    python bench_server.py                       # both setups, /openapi.json
+    python bench_server.py --path /api/users/me --token <jwt>
+    python bench_server.py --only gunicorn --duration 30
+
+The load generator is plain asyncio so no extra dependencies are needed; give
+it enough ``--client-processes`` that it is not the bottleneck.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SERVERS = {
+    "uvicorn --reload": lambda port: [
+        sys.executable, "-m", "uvicorn", "main:app", "--reload", "--port", str(port),
+    ],
+    "gunicorn": lambda port: [
+        sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}",
+    ],
+}
+
+
+def wait_for_port(port: int, timeout: float = 30.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server did not start listening on port {port}")
+
+
+async def _connection(port: int, request: bytes, deadline: float) -> tuple[int, int]:
+    ok = errors = 0
+    while time.time() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            errors += 1
+            await asyncio.sleep(0.05)
+            continue
+        try:
+            while time.time() < deadline:
+                writer.write(request)
+                await writer.drain()
+                status_line = await reader.readline()
+                content_length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b""):
+                        break
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        content_length = int(value)
+                await reader.readexactly(content_length)
+                if status_line.split()[1:2] in ([b"200"], [b"304"]):
+                    ok += 1
+                else:
+                    errors += 1
+        except (OSError, asyncio.IncompleteReadError):
+            # Workers recycled by max_requests close their connections; reconnect.
+            errors += 1
+        finally:
+            writer.close()
+    return ok, errors
+
+
+def _client_process(port: int, request: bytes, connections: int, deadline: float, results) -> None:
+    async def run():
+        return await asyncio.gather(*(_connection(port, request, deadline) for _ in range(connections)))
+
+    counts = asyncio.run(run())
+    results.put((sum(ok for ok, _ in counts), sum(err for _, err in counts)))
+
+
+def run_load(port: int, path: str, headers: dict, duration: float, processes: int, connections: int):
+    header_lines = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    request = f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n{header_lines}\r\n".encode()
+    deadline = time.time() + duration
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=_client_process, args=(port, request, connections, deadline, results))
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    totals = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    return sum(ok for ok, _ in totals), sum(err for _, err in totals)
+
+
+def bench(name: str, args) -> float:
+    command = SERVERS[name](args.port)
+    env = {**os.environ, "PORT": str(args.port)}
+    server = subprocess.Popen(
+        command, cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    try:
+        wait_for_port(args.port)
+        headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+        run_load(args.port, args.path, headers, 2.0, args.client_processes, args.connections)  # warm-up
+        ok, errors = run_load(
+            args.port, args.path, headers, args.duration, args.client_processes, args.connections
+        )
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait(timeout=30)
+
+    rps = ok / args.duration
+    print(f"{name:<18} {rps:>10.1f} req/s  ({ok} ok, {errors} errors)")
+    return rps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", default="/openapi.json")
+    parser.add_argument("--token", help="Bearer token for authenticated endpoints")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--client-processes", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--connections", type=int, default=32, help="connections per client process")
+    parser.add_argument("--only", choices=sorted(SERVERS))
+    args = parser.parse_args()
+
+    names = [args.only] if args.only else list(SERVERS)
+    results = {name: bench(name, args) for name in names}
+    if len(results) == 2 and results["uvicorn --reload"]:
+        print(f"speed-up: {results['gunicorn'] / results['uvicorn --reload']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
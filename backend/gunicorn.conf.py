@@ -0,0 +1,63 @@
+"""Production server configuration.
+
+Run from the ``backend`` directory:
+
+    gunicorn -c gunicorn.conf.py
+
+The app is preloaded in the master process so imported code is shared
+copy-on-write with the workers, and so the shared-memory tables created at
+import time (see ``shared_state.py``) are inherited by every worker.
+"""
+
+import gc
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def _cpu_count() -> int:
+    # Respect container CPU affinity where the platform exposes it.
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+wsgi_app = "main:app"
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# Async workers: one event loop per core. Request handling is CPU-bound
+# (bcrypt, JWT, serialization), so more workers than cores only adds
+# contention.
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", _cpu_count()))
+
+preload_app = True
+
+# Recycle workers gracefully to bound memory growth; jitter keeps them from
+# restarting together.
+max_requests = int(os.getenv("MAX_REQUESTS", "2000"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "200"))
+graceful_timeout = 30
+timeout = 60
+keepalive = 5
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info")
+
+
+def pre_fork(server, worker):
+    # Move everything allocated while preloading into the permanent GC
+    # generation so collections in the workers don't touch (and copy) it.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # The preloaded app opened pooled connections in the master (create_all);
+    # drop them in the child without closing the parent's sockets.
+    from database import engine
+
+    if engine is not None:
+        engine.dispose(close=False)
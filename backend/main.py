@@ -4,9 +4,9 @@
 
 import os
 import time
+import hashlib
 import uuid
 import logging
-from collections import defaultdict
 from datetime import datetime, timedelta
 from typing import Generator
 
@@ -16,12 +16,16 @@ from fastapi import (
     HTTPException,
     Depends,
     Request,
+    Response,
     status,
 )
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel, EmailStr
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.orm import Session, sessionmaker
 from passlib.context import CryptContext
 
@@ -39,6 +43,18 @@ from CRM.email_manager import (
 )
 from models.sql_models import DBUser, DBPasswordResetToken  # type: ignore
 from database import SessionLocal, engine, Base
+from profiling import (
+    PROFILING_ENABLED,
+    ProfilingMiddleware,
+    install_signal_handler,
+    profiler,
+)
+from sql_metrics import (
+    QueryCountMiddleware,
+    install_query_instrumentation,
+    query_budget,
+)
+from shared_state import SharedTable
 
 # ---------------------------------------------------------------------------
 # Environment / configuration
@@ -51,6 +67,12 @@ RESEND_API_KEY = os.getenv("RESEND_API_KEY")
 
 try:
     Base.metadata.create_all(bind=engine)
+    # create_all never alters existing tables; add columns introduced since.
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as connection:
+            connection.execute(
+                text("ALTER TABLE IF EXISTS users ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1")
+            )
     print("✅ Database connection established and tables created.")
 except Exception as e:
     print(f"❌ Database connection failed: {e}")
@@ -88,6 +110,32 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(ProfilingMiddleware)
+
+# Per-request query counts / DB time as response headers (development only)
+if not is_production:
+    if engine is not None:
+        install_query_instrumentation(engine)
+    app.add_middleware(QueryCountMiddleware)
+
+
+@app.exception_handler(StaleDataError)
+async def concurrent_update_handler(request: Request, exc: StaleDataError):
+    # Raised by the users.version check when another request changed the row
+    # between our read and our write.
+    return JSONResponse(
+        status_code=status.HTTP_409_CONFLICT,
+        content={"detail": "The account was modified by another request, please retry"},
+    )
+
+
+@app.on_event("startup")
+async def start_profiler():
+    # Registered at startup (not import) so it runs in each worker process
+    # after the process manager has set up its own signal handlers.
+    install_signal_handler()
+    if PROFILING_ENABLED:
+        profiler.start()
 
 # ---------------------------------------------------------------------------
 # Dependencies & utilities
@@ -130,33 +178,27 @@ def get_db() -> Generator[Session, None, None]:
 
 # ---------------------------- Rate Limiter ---------------------------------
 
-ip_request_counts: dict[str, dict[str, float | int]] = defaultdict(
-    lambda: {"count": 0, "reset_time": time.time()}
-)
 RATE_LIMIT_MINUTES = 1
 MAX_REQUESTS_PER_MINUTE = 5
 
+# Lives in shared memory so the limit holds across gunicorn workers.
+ip_request_counts = SharedTable(slots=16384, ttl=60 * RATE_LIMIT_MINUTES)
+
 
 async def rate_limit(request: Request):
-    """Simple sliding-window IP rate limiter."""
+    """Simple fixed-window IP rate limiter."""
     client_ip = request.client.host
     current_time = time.time()
 
-    # Reset window if expired
-    if current_time - ip_request_counts[client_ip]["reset_time"] >= 60 * RATE_LIMIT_MINUTES:
-        ip_request_counts[client_ip] = {"count": 0, "reset_time": current_time}
-
-    # Block if limit exceeded
-    if ip_request_counts[client_ip]["count"] >= MAX_REQUESTS_PER_MINUTE:
-        reset_time = ip_request_counts[client_ip]["reset_time"] + (60 * RATE_LIMIT_MINUTES)
+    allowed, window_start = ip_request_counts.consume(client_ip, MAX_REQUESTS_PER_MINUTE, now=current_time)
+    if not allowed:
+        reset_time = window_start + (60 * RATE_LIMIT_MINUTES)
         wait_seconds = int(reset_time - current_time)
         raise HTTPException(
             status_code=429,
             detail=f"Rate limit exceeded. Try again in {wait_seconds} seconds",
         )
 
-    ip_request_counts[client_ip]["count"] += 1
-
 
 # ----------------------- Authentication helpers ----------------------------
 
@@ -171,6 +213,137 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> dict:
     return user
 
 
+async def require_admin(current_user: dict = Depends(get_current_user)) -> dict:
+    if not current_user.get("is_admin"):
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    return current_user
+
+
+def get_username_from_token(token: str) -> str:
+    """Return the username embedded in ``token`` or raise a 401."""
+    try:
+        payload = decode_access_token(token)
+        username: str | None = payload.get("username")
+    except Exception:  # noqa: B902, BLE001
+        username = None
+    if not username:
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    return username
+
+
+async def get_current_db_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)) -> DBUser:
+    """Load the ``DBUser`` row for the bearer token."""
+    username = get_username_from_token(token)
+    user = db.query(DBUser).filter(DBUser.username == username).first()
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    return user
+
+
+# ------------------------ ETag / user version cache ------------------------
+
+# "<username>:<identity>" -> latest known version, shared across workers. Lets
+# /api/users/me answer a matching If-None-Match without touching the database.
+# Writers publish the new version after commit (see the session events below)
+# and readers can only raise the cached value, so a read racing a commit can't
+# bring an old version back. Entries only expire to keep the table small.
+USER_VERSION_CACHE_SECONDS = 30
+user_version_cache = SharedTable(slots=16384, ttl=USER_VERSION_CACHE_SECONDS)
+
+# Cached for deleted accounts; higher than any real version so no ETag matches.
+DELETED_USER_VERSION = 2**62
+
+
+def user_identity(username: str, created_at: datetime | None) -> str:
+    """Opaque id for one account that changes if its username is reused."""
+    created = created_at.isoformat() if created_at else ""
+    return hashlib.sha256(f"{username}:{created}".encode("utf-8")).hexdigest()[:16]
+
+
+def user_cache_key(username: str, identity: str) -> str:
+    return f"{username}:{identity}"
+
+
+def make_user_etag(user: DBUser) -> str:
+    return f'"{user_identity(user.username, user.created_at)}-{user.version}"'
+
+
+def etag_candidates(if_none_match: str | None) -> list[str]:
+    """Split an If-None-Match header into entity tags, dropping weak prefixes."""
+    if not if_none_match:
+        return []
+    candidates = []
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        candidates.append(candidate)
+    return candidates
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Evaluate an If-None-Match header against ``etag`` (RFC 9110 weak comparison)."""
+    return any(candidate in ("*", etag) for candidate in etag_candidates(if_none_match))
+
+
+def cached_etag_match(username: str, if_none_match: str | None) -> str | None:
+    """Return the client's ETag if the version cache shows it is still current."""
+    for candidate in etag_candidates(if_none_match):
+        identity, _, version = candidate.strip('"').partition("-")
+        if not version.isdigit():
+            continue
+        entry = user_version_cache.get(user_cache_key(username, identity))
+        if entry is not None and entry[0] == int(version):
+            return candidate
+    return None
+
+
+@event.listens_for(Session, "after_flush")
+def collect_user_versions(session: Session, flush_context) -> None:
+    """Remember the versions written by this flush for ``publish_user_versions``.
+
+    ``version`` is the mapper's version_id_col, so every UPDATE of a user has
+    already bumped it by the time this runs.
+    """
+    pending = session.info.setdefault("user_versions", [])
+    for user in session.dirty:
+        if not isinstance(user, DBUser):
+            continue
+        state = inspect(user)
+        if state.unloaded & {"username", "created_at", "version"}:
+            continue
+        for old_username in state.attrs.username.history.deleted:
+            key = user_cache_key(old_username, user_identity(old_username, user.created_at))
+            pending.append((key, DELETED_USER_VERSION))
+        key = user_cache_key(user.username, user_identity(user.username, user.created_at))
+        pending.append((key, user.version))
+    for user in session.deleted:
+        if not isinstance(user, DBUser) or inspect(user).unloaded & {"username", "created_at"}:
+            continue
+        key = user_cache_key(user.username, user_identity(user.username, user.created_at))
+        pending.append((key, DELETED_USER_VERSION))
+
+
+@event.listens_for(Session, "after_commit")
+def publish_user_versions(session: Session) -> None:
+    for key, version in session.info.pop("user_versions", []):
+        user_version_cache.raise_to(key, version)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_user_versions(session: Session) -> None:
+    session.info.pop("user_versions", None)
+
+
+# Every response for /api/users/me depends on the bearer token, and clients
+# must revalidate before reusing a cached copy.
+USER_ETAG_HEADERS = {"Cache-Control": "private, no-cache", "Vary": "Authorization"}
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag, **USER_ETAG_HEADERS})
+
+
 # ---------------------------------------------------------------------------
 # Pydantic schemas
 # ---------------------------------------------------------------------------
@@ -200,6 +373,12 @@ class PasswordReset(BaseModel):
     new_password: str
 
 
+class ProfilingSettings(BaseModel):
+    sample_rate: float | None = None
+    route: str | None = None  # e.g. "POST /api/login"
+    reset: bool = False
+
+
 # ---------------------------------------------------------------------------
 # Routes – authentication & account management only
 # ---------------------------------------------------------------------------
@@ -259,7 +438,7 @@ async def verify_user_manual(email: str, db: Session = Depends(get_db)):
     return {"message": f"User {email} verified successfully. You may now log in."}
 
 
-@app.post("/api/login")
+@app.post("/api/login", dependencies=[Depends(query_budget(1))])
 async def login(
     form_data: OAuth2PasswordRequestForm = Depends(),
     db: Session = Depends(get_db),
@@ -279,47 +458,75 @@ async def login(
 # ----------------------- Authenticated user endpoints ----------------------
 
 
-@app.get("/api/users/me", tags=["users"])
-async def read_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
-    try:
-        payload = decode_access_token(token)
-        username: str | None = payload.get("username")
-    except Exception:  # noqa: B902, BLE001
-        username = None
-    if not username:
-        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+@app.get("/api/users/me", tags=["users"], dependencies=[Depends(query_budget(1))])
+async def read_current_user(
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme),
+):
+    username = get_username_from_token(token)
+    if_none_match = request.headers.get("if-none-match")
+
+    # Fast path: answer a conditional GET from the version cache alone.
+    cached_etag = cached_etag_match(username, if_none_match)
+    if cached_etag is not None:
+        return not_modified(cached_etag)
 
     user = db.query(DBUser).filter(DBUser.username == username).first()
     if not user:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+
+    identity = user_identity(user.username, user.created_at)
+    user_version_cache.raise_to(user_cache_key(username, identity), user.version)
+    etag = make_user_etag(user)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    response.headers["ETag"] = etag
+    response.headers.update(USER_ETAG_HEADERS)
     return user
 
 
-@app.patch("/api/users/me", tags=["users"])
+@app.patch("/api/users/me", tags=["users"], dependencies=[Depends(query_budget(3))])
 async def update_user(
     user_update: UserUpdate,
     db: Session = Depends(get_db),
-    current_user: DBUser = Depends(read_current_user),
+    current_user: DBUser = Depends(get_current_db_user),
 ):
-    update_data = user_update.dict(exclude_unset=True)
-
-    if "username" in update_data:
-        if db.query(DBUser).filter(DBUser.username == update_data["username"]).first():
-            raise HTTPException(status_code=400, detail="Username already taken")
+    update_data = {
+        key: value
+        for key, value in user_update.dict(exclude_unset=True).items()
+        if getattr(current_user, key) != value
+    }
+    if not update_data:
+        return current_user
 
     for key, value in update_data.items():
         setattr(current_user, key, value)
 
-    db.commit()
+    # The primary key / unique constraints reject duplicates; no need for a
+    # separate lookup round trip.
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        if "username" in update_data and "email" in update_data:
+            detail = "Username or email already taken"
+        elif "username" in update_data:
+            detail = "Username already taken"
+        else:
+            detail = "Email already registered"
+        raise HTTPException(status_code=400, detail=detail)
     db.refresh(current_user)
     return current_user
 
 
-@app.post("/api/users/me/password", tags=["users"])
+@app.post("/api/users/me/password", tags=["users"], dependencies=[Depends(query_budget(2))])
 async def change_password(
     password_change: PasswordChange,
     db: Session = Depends(get_db),
-    current_user: DBUser = Depends(read_current_user),
+    current_user: DBUser = Depends(get_current_db_user),
 ):
     if not verify_password(password_change.current_password, current_user.password):
         raise HTTPException(status_code=400, detail="Incorrect current password")
@@ -329,8 +536,8 @@ async def change_password(
     return {"message": "Password updated successfully"}
 
 
-@app.delete("/api/users/me", tags=["users"])
-async def delete_user(db: Session = Depends(get_db), current_user: DBUser = Depends(read_current_user)):
+@app.delete("/api/users/me", tags=["users"], dependencies=[Depends(query_budget(2))])
+async def delete_user(db: Session = Depends(get_db), current_user: DBUser = Depends(get_current_db_user)):
     db.delete(current_user)
     db.commit()
     return {"message": "Account deleted successfully"}
@@ -399,6 +606,47 @@ async def confirm_password_reset(reset_data: PasswordReset, db: Session = Depend
     return {"message": "Password has been reset successfully"}
 
 
+# ----------------------------- Admin: profiling -----------------------------
+# Settings are shared by all workers, so any worker can serve these calls.
+# Status and exports merge the samples each worker flushes to
+# PROFILING_OUTPUT_DIR every PROFILING_FLUSH_SECONDS; the newest few seconds
+# of other workers may be missing until their next flush.
+
+
+@app.get("/api/admin/profiling", tags=["admin"])
+async def profiling_status(_: dict = Depends(require_admin)):
+    return profiler.status()
+
+
+@app.post("/api/admin/profiling", tags=["admin"])
+async def start_profiling(settings: ProfilingSettings, _: dict = Depends(require_admin)):
+    if settings.reset:
+        profiler.reset()
+    try:
+        profiler.start(sample_rate=settings.sample_rate, route=settings.route)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return profiler.status()
+
+
+@app.delete("/api/admin/profiling", tags=["admin"])
+async def stop_profiling(_: dict = Depends(require_admin)):
+    profiler.stop()
+    return profiler.status()
+
+
+@app.get("/api/admin/profiling/export", tags=["admin"])
+async def export_profile(format: str = "collapsed", _: dict = Depends(require_admin)):
+    if format == "collapsed":
+        return PlainTextResponse(
+            profiler.export_collapsed(),
+            headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'},
+        )
+    if format == "speedscope":
+        return profiler.export_speedscope()
+    raise HTTPException(status_code=400, detail="format must be 'collapsed' or 'speedscope'")
+
+
 # ---------------------------------------------------------------------------
 # END
 # ---------------------------------------------------------------------------
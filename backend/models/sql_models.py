@@ -36,6 +36,12 @@ class DBUser(Base):
     # Verification token used during sign-up; cleared upon email verification
     verification_token = Column(String, nullable=True)
 
+    # Bumped by SQLAlchemy in every UPDATE of the row (version_id_col below);
+    # used to build the ETag for /api/users/me
+    version = Column(Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
+
 
 class DBPasswordResetToken(Base):
     __tablename__ = "password_reset_tokens"
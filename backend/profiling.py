@@ -0,0 +1,444 @@
+"""Opt-in sampling profiler for live requests.
+
+The profiler is off by default and costs one shared-memory read per request
+while disabled. Once enabled (through the admin endpoints in ``main.py`` or by
+sending ``SIGUSR2`` to any worker) every worker runs a background thread that
+samples the Python stacks of its threads at a fixed interval. Samples that fall inside a request picked
+for profiling are aggregated per route, so the output shows where time goes
+inside an endpoint (bcrypt, jwt, SQLAlchemy, Pydantic, ...) rather than in the
+server loop.
+
+Results of all workers can be exported as collapsed stacks (for
+``flamegraph.pl`` / speedscope) or as a speedscope JSON document.
+"""
+
+import ctypes
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from dotenv import load_dotenv
+from starlette.routing import Match
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0.01"))
+PROFILING_INTERVAL_MS = float(os.getenv("PROFILING_INTERVAL_MS", "5"))
+PROFILING_OUTPUT_DIR = os.getenv("PROFILING_OUTPUT_DIR", "profiles")
+# How often each worker writes its samples to PROFILING_OUTPUT_DIR for export.
+PROFILING_FLUSH_SECONDS = float(os.getenv("PROFILING_FLUSH_SECONDS", "5"))
+
+# Requests carrying this header are always profiled while the profiler is on.
+PROFILE_HEADER = b"x-profile"
+
+MAX_STACK_DEPTH = 128
+MAX_ROUTE_FILTER_BYTES = 256
+
+
+def _frame_label(code) -> str:
+    # ';' separates frames in the collapsed-stack format.
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+class SamplingProfiler:
+    """Statistical profiler that attributes stack samples to routes.
+
+    Settings (enabled, sample rate, route filter) live in shared memory, so a
+    change made in any gunicorn worker reaches all of them: each worker picks
+    it up on its next request or sampler tick. Samples stay in the worker that
+    took them and are flushed to ``worker-<pid>.json`` in ``output_dir``;
+    status and exports merge those files.
+    """
+
+    def __init__(
+        self,
+        interval_ms: float = PROFILING_INTERVAL_MS,
+        sample_rate: float = PROFILING_SAMPLE_RATE,
+        output_dir: str = PROFILING_OUTPUT_DIR,
+    ):
+        self.interval = interval_ms / 1000.0
+        self.output_dir = output_dir
+
+        self._shared_enabled = multiprocessing.RawValue(ctypes.c_bool, False)
+        self._shared_sample_rate = multiprocessing.RawValue(ctypes.c_double, sample_rate)
+        self._shared_route = multiprocessing.RawArray(ctypes.c_char, MAX_ROUTE_FILTER_BYTES)
+        self._shared_started_at = multiprocessing.RawValue(ctypes.c_double, 0.0)
+        # Bumped on every settings change / reset; workers compare it with
+        # the generation they last applied.
+        self._shared_generation = multiprocessing.RawValue(ctypes.c_long, 0)
+        self._shared_reset = multiprocessing.RawValue(ctypes.c_long, 0)
+
+        # Per-process state
+        self.sample_rate = sample_rate
+        self.route_filter: str | None = None
+        self._generation = 0
+        self._reset_generation = 0
+        self._sync_lock = threading.Lock()
+
+        # Frame of an in-flight profiled request -> route template.
+        self._active: dict = {}
+        self._stacks: dict[str, Counter] = defaultdict(Counter)
+        self._requests: Counter = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    # ------------------------------------------------------------------ control
+
+    @property
+    def enabled(self) -> bool:
+        return self._shared_enabled.value
+
+    @property
+    def running(self) -> bool:
+        """Whether this process is currently sampling."""
+        return self._thread is not None
+
+    def start(self, sample_rate: float | None = None, route: str | None = None) -> None:
+        if sample_rate is not None and not 0.0 <= sample_rate <= 1.0:
+            raise ValueError("sample_rate must be between 0 and 1")
+        encoded_route = (route or "").encode("utf-8")
+        if len(encoded_route) >= MAX_ROUTE_FILTER_BYTES:
+            raise ValueError(f"route must be shorter than {MAX_ROUTE_FILTER_BYTES} bytes")
+
+        if sample_rate is not None:
+            self._shared_sample_rate.value = sample_rate
+        self._shared_route.value = encoded_route
+        if not self._shared_enabled.value:
+            self._shared_started_at.value = time.time()
+            self._shared_enabled.value = True
+        self._shared_generation.value += 1
+        self.sync()
+        logger.info("Profiler enabled (sample_rate=%s, route=%s)", self.sample_rate, self.route_filter)
+
+    def stop(self) -> None:
+        if not self._shared_enabled.value:
+            return
+        self._shared_enabled.value = False
+        self._shared_generation.value += 1
+        self.sync()
+        logger.info("Profiler disabled")
+
+    def reset(self) -> None:
+        """Discard the samples of every worker."""
+        self._shared_reset.value += 1
+        self._shared_generation.value += 1
+        for path in self._worker_files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.sync()
+
+    def sync(self) -> None:
+        """Apply settings changed by any process; cheap when nothing changed."""
+        if self._shared_generation.value != self._generation:
+            self._apply()
+
+    def _apply(self) -> None:
+        with self._sync_lock:
+            self._generation = self._shared_generation.value
+            if self._shared_reset.value != self._reset_generation:
+                self._reset_generation = self._shared_reset.value
+                with self._lock:
+                    self._stacks.clear()
+                    self._requests.clear()
+            self.sample_rate = self._shared_sample_rate.value
+            self.route_filter = self._shared_route.value.decode("utf-8") or None
+
+            if self._shared_enabled.value and self._thread is None:
+                # A fresh event per thread, so a sampler that is shutting
+                # itself down can't be revived by the next start.
+                self._stop = threading.Event()
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._stop,), name="sampling-profiler", daemon=True
+                )
+                self._thread.start()
+            elif not self._shared_enabled.value and self._thread is not None:
+                self._stop.set()
+                if self._thread is not threading.current_thread():
+                    self._thread.join(timeout=1.0)
+                self._thread = None
+                self._flush()
+
+    def status(self) -> dict:
+        requests, stacks, pids = self._merged()
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self._shared_sample_rate.value,
+            "route": self._shared_route.value.decode("utf-8") or None,
+            "interval_ms": self.interval * 1000.0,
+            "started_at": self._shared_started_at.value or None,
+            "workers": sorted(pids),
+            "requests": dict(requests),
+            "samples": {route: sum(route_stacks.values()) for route, route_stacks in stacks.items()},
+        }
+
+    # --------------------------------------------------------------- selection
+
+    def should_profile(self, route: str, headers: list[tuple[bytes, bytes]]) -> bool:
+        if self.route_filter is not None and route != self.route_filter:
+            return False
+        if any(name == PROFILE_HEADER for name, _ in headers):
+            return True
+        return random.random() < self.sample_rate
+
+    def enter(self, frame, route: str) -> None:
+        self._active[frame] = route
+        with self._lock:
+            self._requests[route] += 1
+
+    def exit(self, frame) -> None:
+        self._active.pop(frame, None)
+
+    # ---------------------------------------------------------------- sampling
+
+    def _run(self, stop: threading.Event) -> None:
+        own_id = threading.get_ident()
+        next_flush = time.monotonic() + PROFILING_FLUSH_SECONDS
+        while not stop.wait(self.interval):
+            # Idle workers get no requests, so notice setting changes here too.
+            if self._shared_generation.value != self._generation:
+                self._apply()
+                continue
+            if time.monotonic() >= next_flush:
+                self._flush()
+                next_flush = time.monotonic() + PROFILING_FLUSH_SECONDS
+            if not self._active:
+                continue
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self._sample(frame)
+
+    def _sample(self, frame) -> None:
+        # Walk from the leaf towards the root until we reach the frame of a
+        # profiled request; anything above it is server machinery.
+        stack = []
+        active = self._active
+        while frame is not None and len(stack) < MAX_STACK_DEPTH:
+            route = active.get(frame)
+            if route is not None:
+                stack.reverse()
+                with self._lock:
+                    self._stacks[route][tuple(stack)] += 1
+                return
+            stack.append(_frame_label(frame.f_code))
+            frame = frame.f_back
+
+    # ------------------------------------------------------- per-worker files
+
+    def _worker_file(self, pid: int) -> str:
+        return os.path.join(self.output_dir, f"worker-{pid}.json")
+
+    def _worker_files(self) -> list[str]:
+        return glob.glob(os.path.join(self.output_dir, "worker-*.json"))
+
+    def _local_snapshot(self) -> tuple[Counter, dict[str, Counter]]:
+        with self._lock:
+            return Counter(self._requests), {route: Counter(stacks) for route, stacks in self._stacks.items()}
+
+    def _flush(self) -> None:
+        """Write this worker's samples so other workers can export them."""
+        requests, stacks = self._local_snapshot()
+        if not requests and not stacks:
+            return
+        document = {
+            "requests": requests,
+            "stacks": [[route, list(stack), count] for route, counts in stacks.items() for stack, count in counts.items()],
+        }
+        path = self._worker_file(os.getpid())
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(document, f)
+            os.replace(f"{path}.tmp", path)
+        except OSError:
+            logger.exception("Could not write profiler samples to %s", path)
+
+    def _merged(self) -> tuple[Counter, dict[str, Counter], set[int]]:
+        """Samples of this process plus the files flushed by other workers."""
+        requests, stacks = self._local_snapshot()
+        stacks = defaultdict(Counter, stacks)
+        pids = {os.getpid()} if requests or stacks else set()
+        own_file = self._worker_file(os.getpid())
+        for path in self._worker_files():
+            if path == own_file:
+                continue
+            try:
+                with open(path) as f:
+                    document = json.load(f)
+            except (OSError, ValueError):
+                continue
+            pids.add(int(os.path.basename(path)[len("worker-"):-len(".json")]))
+            requests.update(document["requests"])
+            for route, stack, count in document["stacks"]:
+                stacks[route][tuple(stack)] += count
+        return requests, dict(stacks), pids
+
+    # ------------------------------------------------------------------ export
+
+    def snapshot(self) -> dict[str, Counter]:
+        return self._merged()[1]
+
+    def export_collapsed(self) -> str:
+        """Return samples in Brendan Gregg's collapsed-stack format."""
+        lines = []
+        for route, stacks in sorted(self.snapshot().items()):
+            for stack, count in stacks.most_common():
+                lines.append(";".join((route, *stack)) + f" {count}")
+        return "\n".join(lines) + ("\n" if lines else "")
+
+    def export_speedscope(self) -> dict:
+        """Return samples as a speedscope document with one profile per route."""
+        frames: list[dict] = []
+        frame_index: dict[str, int] = {}
+        profiles = []
+
+        for route, stacks in sorted(self.snapshot().items()):
+            samples = []
+            weights = []
+            for stack, count in stacks.most_common():
+                indices = []
+                for label in stack:
+                    if label not in frame_index:
+                        frame_index[label] = len(frames)
+                        frames.append({"name": label})
+                    indices.append(frame_index[label])
+                samples.append(indices)
+                weights.append(count * self.interval)
+            profiles.append(
+                {
+                    "type": "sampled",
+                    "name": route,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": sum(weights),
+                    "samples": samples,
+                    "weights": weights,
+                }
+            )
+
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": profiles,
+            "name": "backend",
+            "exporter": "backend.profiling",
+        }
+
+    def dump(self, directory: str | None = None) -> list[str]:
+        """Write both export formats to ``directory`` and return the paths."""
+        directory = directory or self.output_dir
+        os.makedirs(directory, exist_ok=True)
+        stem = os.path.join(directory, f"profile-{os.getpid()}-{int(time.time())}")
+        collapsed_path = f"{stem}.collapsed"
+        speedscope_path = f"{stem}.speedscope.json"
+        with open(collapsed_path, "w") as f:
+            f.write(self.export_collapsed())
+        with open(speedscope_path, "w") as f:
+            json.dump(self.export_speedscope(), f)
+        return [collapsed_path, speedscope_path]
+
+
+profiler = SamplingProfiler()
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that marks selected requests for the sampling profiler."""
+
+    def __init__(self, app, profiler: SamplingProfiler = profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        self.profiler.sync()
+        if not self.profiler.running or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = self._route_for(scope)
+        if not self.profiler.should_profile(route, scope.get("headers", [])):
+            await self.app(scope, receive, send)
+            return
+
+        await self._profiled_call(scope, receive, send, route)
+
+    async def _profiled_call(self, scope, receive, send, route):
+        # The frame of this coroutine stays the same across awaits, so the
+        # sampler can recognise it as the root of the request's stack.
+        frame = sys._getframe()
+        self.profiler.enter(frame, route)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.profiler.exit(frame)
+
+    def _route_for(self, scope) -> str:
+        router = scope["app"].router if "app" in scope else None
+        if router is not None:
+            for candidate in router.routes:
+                match, _ = candidate.matches(scope)
+                if match == Match.FULL:
+                    return f"{scope['method']} {candidate.path}"
+        # One bucket for all unmatched paths so arbitrary URLs can't grow the
+        # aggregation tables.
+        return f"{scope['method']} <unmatched>"
+
+
+_toggle_requested = threading.Event()
+_signal_thread: threading.Thread | None = None
+
+
+def _toggle_profiler() -> None:
+    if profiler.enabled:
+        profiler.stop()
+        paths = profiler.dump()
+        logger.warning("Profiler stopped by signal, wrote %s", ", ".join(paths))
+    else:
+        profiler.start()
+        logger.warning("Profiler started by signal")
+
+
+def _watch_toggle_requests() -> None:
+    while True:
+        _toggle_requested.wait()
+        _toggle_requested.clear()
+        try:
+            _toggle_profiler()
+        except Exception:  # noqa: BLE001
+            logger.exception("Profiler toggle failed")
+
+
+def install_signal_handler(sig: int = getattr(signal, "SIGUSR2", 0)) -> None:
+    """Toggle the profiler on ``sig``; turning it off dumps results to disk."""
+    global _signal_thread
+    if not sig:
+        return  # e.g. Windows
+    if threading.current_thread() is not threading.main_thread():
+        # signal.signal() only works in the main thread (not e.g. under TestClient).
+        logger.info("Not in the main thread; profiler signal handler not installed")
+        return
+
+    # The handler interrupts the main thread, possibly while it holds the
+    # profiler's lock, so it only sets an event; stopping, joining the sampler
+    # and writing files happen on a helper thread.
+    if _signal_thread is None:
+        _signal_thread = threading.Thread(target=_watch_toggle_requests, name="profiler-signal", daemon=True)
+        _signal_thread.start()
+
+    def _toggle(signum, _frame):
+        _toggle_requested.set()
+
+    signal.signal(sig, _toggle)
@@ -0,0 +1,201 @@
+"""Small fixed-size tables in anonymous shared memory.
+
+Under gunicorn (see ``gunicorn.conf.py``) the app is preloaded in the master
+process, so tables created at import time are inherited by every forked
+worker and updates are visible to all of them. Under a single
+``uvicorn --reload`` process they behave like a plain in-process dict.
+
+Each table maps a string key to an ``(int value, float timestamp)`` pair and
+forgets entries older than its ``ttl``. Keys are hashed to 64 bits and placed
+with short linear probing; when every probed slot holds a live entry the
+oldest one is evicted, so a full table degrades by forgetting, never by
+failing.
+
+Access is serialised with a POSIX record lock, which the kernel releases when
+its holder dies, so a worker killed mid-update can't wedge the others. Lock
+waits are bounded; on timeout operations fail open (cache miss, request
+allowed) rather than stall the event loop.
+"""
+
+import ctypes
+import fcntl
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PROBE_LENGTH = 8
+LOCK_TIMEOUT_SECONDS = 0.05
+
+EMPTY = 0
+
+
+def _hash_key(key: str) -> int:
+    # Python's hash() is salted per interpreter; this must agree across processes.
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+class ProcessLock:
+    """Mutex shared by forked processes that dies with its holder.
+
+    Record locks (``lockf``) belong to the process, not the file descriptor,
+    so every forked worker can lock the inherited descriptor and a killed
+    holder's lock is dropped by the kernel. They don't exclude threads of the
+    same process, hence the additional thread lock.
+    """
+
+    def __init__(self):
+        fd, path = tempfile.mkstemp(prefix="shared-table-", suffix=".lock")
+        os.unlink(path)
+        self._fd = fd
+        self._thread_lock = threading.Lock()
+        # A thread lock held by another thread at fork time would stay
+        # locked forever in the child.
+        os.register_at_fork(after_in_child=self._reset_thread_lock)
+
+    def _reset_thread_lock(self) -> None:
+        self._thread_lock = threading.Lock()
+
+    def acquire(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        if not self._thread_lock.acquire(timeout=timeout):
+            return False
+        while True:
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except OSError:
+                if time.monotonic() >= deadline:
+                    self._thread_lock.release()
+                    return False
+                time.sleep(0.0005)
+
+    def release(self) -> None:
+        fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+
+class SharedTable:
+    """Cross-process ``key -> (value, timestamp)`` table with expiry."""
+
+    def __init__(self, slots: int, ttl: float):
+        self.slots = slots
+        self.ttl = ttl
+        self._lock = ProcessLock()
+        self._keys = multiprocessing.RawArray(ctypes.c_uint64, slots)
+        self._values = multiprocessing.RawArray(ctypes.c_int64, slots)
+        self._stamps = multiprocessing.RawArray(ctypes.c_double, slots)
+
+    @contextmanager
+    def _locked(self):
+        """Yield whether the lock was acquired within ``LOCK_TIMEOUT_SECONDS``."""
+        if not self._lock.acquire(LOCK_TIMEOUT_SECONDS):
+            logger.warning("Shared table lock timed out; failing open")
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self._lock.release()
+
+    def _probe(self, hashed: int):
+        start = hashed % self.slots
+        return [(start + i) % self.slots for i in range(PROBE_LENGTH)]
+
+    def _is_live(self, slot: int, now: float) -> bool:
+        return self._keys[slot] != EMPTY and now - self._stamps[slot] < self.ttl
+
+    def _find(self, hashed: int, now: float) -> int | None:
+        for slot in self._probe(hashed):
+            if self._keys[slot] == hashed and self._is_live(slot, now):
+                return slot
+        return None
+
+    def _claim(self, hashed: int, now: float) -> int:
+        """Return the slot for ``hashed``, reusing a free, expired or oldest slot."""
+        probe = self._probe(hashed)
+        for slot in probe:
+            if self._keys[slot] == hashed:
+                return slot
+        for slot in probe:
+            if not self._is_live(slot, now):
+                return slot
+        return min(probe, key=lambda slot: self._stamps[slot])
+
+    def get(self, key: str, now: float | None = None) -> tuple[int, float] | None:
+        now = time.time() if now is None else now
+        hashed = _hash_key(key)
+        with self._locked() as acquired:
+            if not acquired:
+                return None
+            slot = self._find(hashed, now)
+            if slot is None:
+                return None
+            return self._values[slot], self._stamps[slot]
+
+    def set(self, key: str, value: int, now: float | None = None) -> None:
+        now = time.time() if now is None else now
+        hashed = _hash_key(key)
+        with self._locked() as acquired:
+            if not acquired:
+                return
+            slot = self._claim(hashed, now)
+            self._keys[slot] = hashed
+            self._values[slot] = value
+            self._stamps[slot] = now
+
+    def raise_to(self, key: str, value: int, now: float | None = None) -> None:
+        """Store ``value`` unless the live entry for ``key`` is already higher."""
+        now = time.time() if now is None else now
+        hashed = _hash_key(key)
+        with self._locked() as acquired:
+            if not acquired:
+                return
+            slot = self._find(hashed, now)
+            if slot is not None and self._values[slot] >= value:
+                self._stamps[slot] = now
+                return
+            slot = self._claim(hashed, now)
+            self._keys[slot] = hashed
+            self._values[slot] = value
+            self._stamps[slot] = now
+
+    def pop(self, key: str) -> None:
+        hashed = _hash_key(key)
+        with self._locked() as acquired:
+            if not acquired:
+                return
+            for slot in self._probe(hashed):
+                if self._keys[slot] == hashed:
+                    # Keep the key so probe chains stay intact; a zero
+                    # timestamp marks the entry as expired.
+                    self._stamps[slot] = 0.0
+
+    def consume(self, key: str, limit: int, now: float | None = None) -> tuple[bool, float]:
+        """Count one hit against ``key`` in a window of ``ttl`` seconds.
+
+        Returns ``(allowed, window_start)``. Hits beyond ``limit`` are rejected
+        and not counted; if the lock can't be taken the hit is allowed.
+        """
+        now = time.time() if now is None else now
+        hashed = _hash_key(key)
+        with self._locked() as acquired:
+            if not acquired:
+                return True, now
+            slot = self._find(hashed, now)
+            if slot is None:
+                slot = self._claim(hashed, now)
+                self._keys[slot] = hashed
+                self._values[slot] = 0
+                self._stamps[slot] = now
+            if self._values[slot] >= limit:
+                return False, self._stamps[slot]
+            self._values[slot] += 1
+            return True, self._stamps[slot]
@@ -0,0 +1,144 @@
+"""Per-request SQL query accounting for non-production environments.
+
+``install_query_instrumentation`` hooks SQLAlchemy's cursor events so every
+statement executed while handling a request is counted and timed.
+``QueryCountMiddleware`` reports the totals as response headers:
+
+    X-DB-Query-Count      number of statements executed
+    X-DB-Time-Ms          total time spent in the database driver
+    X-DB-Repeated-Queries statements executed more than once (likely N+1)
+    X-DB-Query-Budget     the route's declared budget, if any
+
+Routes declare a ceiling with ``dependencies=[Depends(query_budget(n))]`` and
+tests check it with ``assert_query_budget(response)``.
+"""
+
+import logging
+import os
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from dotenv import load_dotenv
+from sqlalchemy import event
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Statements executed at least this many times in one request are reported.
+SQL_REPEAT_THRESHOLD = int(os.getenv("SQL_REPEAT_THRESHOLD", "2"))
+
+QUERY_COUNT_HEADER = "X-DB-Query-Count"
+QUERY_TIME_HEADER = "X-DB-Time-Ms"
+REPEATED_QUERIES_HEADER = "X-DB-Repeated-Queries"
+QUERY_BUDGET_HEADER = "X-DB-Query-Budget"
+
+
+class QueryStats:
+    """Statements executed while handling a single request."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.statements: Counter = Counter()
+        self.budget: int | None = None
+
+    def record(self, statement: str, elapsed: float) -> None:
+        self.count += 1
+        self.total_time += elapsed
+        self.statements[statement] += 1
+
+    def repeated(self, threshold: int = SQL_REPEAT_THRESHOLD) -> dict[str, int]:
+        return {sql: n for sql, n in self.statements.items() if n >= threshold}
+
+    @property
+    def over_budget(self) -> bool:
+        return self.budget is not None and self.count > self.budget
+
+
+_current_stats: ContextVar[QueryStats | None] = ContextVar("sql_query_stats", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start_time = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.record(statement, time.perf_counter() - context._query_start_time)
+
+
+def install_query_instrumentation(engine) -> None:
+    """Attach the query counters to ``engine`` (idempotent)."""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def query_budget(max_queries: int):
+    """Dependency factory declaring the maximum number of queries for a route."""
+
+    async def _declare_budget():
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.budget = max_queries
+
+    return _declare_budget
+
+
+class QueryCountMiddleware:
+    """ASGI middleware that collects ``QueryStats`` and reports them as headers."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+        token = _current_stats.set(stats)
+
+        async def send_with_stats(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((QUERY_COUNT_HEADER.lower().encode(), str(stats.count).encode()))
+                headers.append((QUERY_TIME_HEADER.lower().encode(), f"{stats.total_time * 1000:.2f}".encode()))
+                repeated = stats.repeated()
+                if repeated:
+                    headers.append((REPEATED_QUERIES_HEADER.lower().encode(), str(len(repeated)).encode()))
+                    for sql, n in repeated.items():
+                        logger.warning("%s %s ran %d times: %s", scope["method"], scope["path"], n, sql)
+                if stats.budget is not None:
+                    headers.append((QUERY_BUDGET_HEADER.lower().encode(), str(stats.budget).encode()))
+                    if stats.over_budget:
+                        logger.warning(
+                            "%s %s exceeded its query budget: %d > %d",
+                            scope["method"], scope["path"], stats.count, stats.budget,
+                        )
+                message["headers"] = headers
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            _current_stats.reset(token)
+
+
+def assert_query_budget(response, max_queries: int | None = None) -> None:
+    """Fail if ``response`` issued more queries than allowed.
+
+    Uses the route's declared ``query_budget`` unless ``max_queries`` is given.
+    """
+    if QUERY_COUNT_HEADER not in response.headers:
+        raise AssertionError(f"{QUERY_COUNT_HEADER} header missing; is QueryCountMiddleware installed?")
+    count = int(response.headers[QUERY_COUNT_HEADER])
+    if max_queries is None:
+        if QUERY_BUDGET_HEADER not in response.headers:
+            raise AssertionError("Route declares no query budget and max_queries was not given")
+        max_queries = int(response.headers[QUERY_BUDGET_HEADER])
+    if count > max_queries:
+        raise AssertionError(f"Expected at most {max_queries} queries, got {count}")
@@ -0,0 +1,91 @@
+import json
+import os
+import sqlite3
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+os.environ.setdefault("JWT_SECRET", "test-secret")
+os.environ.pop("DATABASE_URL", None)
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.dialects import postgresql  # noqa: E402
+from sqlalchemy.ext.compiler import compiles  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from sqlalchemy.pool import StaticPool  # noqa: E402
+
+
+# DBUser.badges is a Postgres ARRAY; store it as JSON text on SQLite.
+@compiles(postgresql.ARRAY, "sqlite")
+def _compile_array_for_sqlite(type_, compiler, **kw):
+    return "JSON"
+
+
+sqlite3.register_adapter(list, json.dumps)
+
+
+@pytest.fixture()
+def engine():
+    from models.sql_models import Base
+    from sql_metrics import install_query_instrumentation
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    install_query_instrumentation(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture()
+def db_session(engine):
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    session = SessionLocal()
+    yield session
+    session.close()
+
+
+@pytest.fixture()
+def client(engine):
+    from fastapi.testclient import TestClient
+
+    import main
+
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def override_get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    main.app.dependency_overrides[main.get_db] = override_get_db
+    with TestClient(main.app) as client:
+        yield client
+    main.app.dependency_overrides.clear()
+
+
+@pytest.fixture()
+def user(db_session):
+    from auth import hash_password
+    from models.sql_models import DBUser
+
+    db_user = DBUser(
+        username="alice",
+        email="alice@example.com",
+        password=hash_password("secret"),
+        email_is_verified=True,
+    )
+    db_session.add(db_user)
+    db_session.commit()
+    return db_user
+
+
+def auth_headers(username="alice", **extra):
+    from auth import create_access_token
+
+    token = create_access_token({"username": username, "is_admin": False})
+    return {"Authorization": f"Bearer {token}", **extra}
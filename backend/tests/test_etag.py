@@ -0,0 +1,103 @@
+import pytest
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+
+import main
+from auth import hash_password
+from conftest import auth_headers
+from models.sql_models import DBUser
+
+
+def test_etag_matches():
+    etag = '"abc"'
+    assert main.etag_matches('"abc"', etag)
+    assert main.etag_matches('W/"abc"', etag)
+    assert main.etag_matches('"x", "abc"', etag)
+    assert main.etag_matches("*", etag)
+    assert not main.etag_matches('"x"', etag)
+    assert not main.etag_matches(None, etag)
+
+
+def test_read_current_user_returns_etag_and_304(client, user):
+    response = client.get("/api/users/me", headers=auth_headers())
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert response.json()["username"] == "alice"
+
+    response = client.get("/api/users/me", headers=auth_headers(**{"If-None-Match": etag}))
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    # Answered from the version cache without touching the database.
+    assert response.headers["X-DB-Query-Count"] == "0"
+
+
+def test_update_invalidates_etag(client, user):
+    etag = client.get("/api/users/me", headers=auth_headers()).headers["ETag"]
+
+    response = client.patch("/api/users/me", json={"email": "new@example.com"}, headers=auth_headers())
+    assert response.status_code == 200
+
+    response = client.get("/api/users/me", headers=auth_headers(**{"If-None-Match": etag}))
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()["email"] == "new@example.com"
+
+
+@pytest.mark.parametrize(
+    "method, path, body",
+    [
+        ("post", "/api/users/me/password", {"current_password": "secret", "new_password": "hunter2"}),
+        ("post", "/api/verify-user/alice@example.com", None),
+    ],
+)
+def test_other_writes_invalidate_etag(client, user, db_session, method, path, body):
+    user.email_is_verified = False
+    db_session.commit()
+    etag = client.get("/api/users/me", headers=auth_headers()).headers["ETag"]
+    assert getattr(client, method)(path, json=body, headers=auth_headers()).status_code == 200
+
+    response = client.get("/api/users/me", headers=auth_headers(**{"If-None-Match": etag}))
+    assert response.status_code == 200
+
+
+def test_empty_update_keeps_version(client, user):
+    response = client.patch("/api/users/me", json={}, headers=auth_headers())
+    assert response.status_code == 200
+    assert response.json()["version"] == 1
+
+
+def test_concurrent_writes_do_not_share_a_version(engine, user):
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    first, second = SessionLocal(), SessionLocal()
+    first.get(DBUser, "alice").email = "one@example.com"
+    second.get(DBUser, "alice").email = "two@example.com"
+
+    first.commit()
+    with pytest.raises(StaleDataError):
+        second.commit()
+
+
+def test_stale_read_cannot_lower_cached_version(client, user, db_session):
+    identity = main.user_identity("alice", user.created_at)
+    key = main.user_cache_key("alice", identity)
+    old_etag = client.get("/api/users/me", headers=auth_headers()).headers["ETag"]
+
+    client.patch("/api/users/me", json={"email": "new@example.com"}, headers=auth_headers())
+    # A reader that loaded the row before the commit publishes the old version.
+    main.user_version_cache.raise_to(key, 1)
+
+    response = client.get("/api/users/me", headers=auth_headers(**{"If-None-Match": old_etag}))
+    assert response.status_code == 200
+
+
+def test_reused_username_gets_a_new_etag(client, user, db_session):
+    old_etag = client.get("/api/users/me", headers=auth_headers()).headers["ETag"]
+    assert client.delete("/api/users/me", headers=auth_headers()).status_code == 200
+
+    db_session.add(DBUser(username="alice", email="alice2@example.com", password=hash_password("x")))
+    db_session.commit()
+
+    response = client.get("/api/users/me", headers=auth_headers(**{"If-None-Match": old_etag}))
+    assert response.status_code == 200
+    assert response.headers["ETag"] != old_etag
+    assert response.json()["email"] == "alice2@example.com"
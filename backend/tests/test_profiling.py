@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from profiling import ProfilingMiddleware, SamplingProfiler
+
+
+@pytest.fixture()
+def profiler(tmp_path):
+    profiler = SamplingProfiler(interval_ms=1, sample_rate=0.0, output_dir=str(tmp_path))
+    yield profiler
+    profiler.stop()
+
+
+@pytest.fixture()
+def client(profiler):
+    app = FastAPI()
+    app.add_middleware(ProfilingMiddleware, profiler=profiler)
+
+    @app.get("/items/{item_id}")
+    async def read_item(item_id: int):
+        deadline = time.time() + 0.05
+        while time.time() < deadline:
+            hashlib.sha256(b"x" * 1024).digest()
+        return {"item_id": item_id}
+
+    return TestClient(app)
+
+
+def test_off_by_default(client, profiler):
+    client.get("/items/1", headers={"X-Profile": "1"})
+    assert profiler.status()["requests"] == {}
+
+
+def test_samples_are_aggregated_per_route(client, profiler):
+    profiler.start()
+    client.get("/items/1", headers={"X-Profile": "1"})
+    client.get("/items/2", headers={"X-Profile": "1"})
+    client.get("/items/3")  # not selected: sample_rate is 0
+    profiler.stop()
+
+    status = profiler.status()
+    assert status["requests"] == {"GET /items/{item_id}": 2}
+    assert status["samples"]["GET /items/{item_id}"] > 0
+
+
+def test_unmatched_paths_share_a_bucket(client, profiler):
+    profiler.start()
+    client.get("/nope/1", headers={"X-Profile": "1"})
+    client.get("/nope/2", headers={"X-Profile": "1"})
+    profiler.stop()
+    assert profiler.status()["requests"] == {"GET <unmatched>": 2}
+
+
+def test_route_filter(client, profiler):
+    profiler.start(route="GET /other")
+    client.get("/items/1", headers={"X-Profile": "1"})
+    assert profiler.status()["requests"] == {}
+
+
+def test_exports(client, profiler):
+    profiler.start()
+    client.get("/items/1", headers={"X-Profile": "1"})
+    profiler.stop()
+
+    collapsed = profiler.export_collapsed()
+    assert collapsed.startswith("GET /items/{item_id};")
+    assert "read_item" in collapsed
+
+    document = profiler.export_speedscope()
+    (profile,) = document["profiles"]
+    assert profile["name"] == "GET /items/{item_id}"
+    assert len(profile["samples"]) == len(profile["weights"])
+    names = {frame["name"] for frame in document["shared"]["frames"]}
+    assert any(name.startswith("read_item") for name in names)
+
+
+def test_invalid_sample_rate(profiler):
+    with pytest.raises(ValueError):
+        profiler.start(sample_rate=2)
+
+
+def test_settings_are_shared_with_forked_workers(profiler):
+    pid = os.fork()
+    if pid == 0:
+        # Another worker handles the admin call.
+        profiler.start(sample_rate=0.5, route="GET /items/{item_id}")
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    assert profiler.enabled
+    profiler.sync()
+    assert profiler.running
+    assert profiler.sample_rate == 0.5
+    assert profiler.route_filter == "GET /items/{item_id}"
+
+
+def test_exports_merge_other_workers(client, profiler, tmp_path):
+    other = {"requests": {"GET /other": 3}, "stacks": [["GET /other", ["handler (x.py:1)"], 7]]}
+    (tmp_path / "worker-999999.json").write_text(json.dumps(other))
+
+    profiler.start()
+    client.get("/items/1", headers={"X-Profile": "1"})
+    profiler.stop()
+
+    status = profiler.status()
+    assert status["requests"] == {"GET /items/{item_id}": 1, "GET /other": 3}
+    assert status["samples"]["GET /other"] == 7
+    assert 999999 in status["workers"]
+    assert "GET /other;handler (x.py:1) 7" in profiler.export_collapsed()
+
+
+def test_reset_discards_every_workers_samples(client, profiler, tmp_path):
+    (tmp_path / "worker-999999.json").write_text(json.dumps({"requests": {"GET /other": 1}, "stacks": []}))
+    profiler.start()
+    client.get("/items/1", headers={"X-Profile": "1"})
+    profiler.reset()
+    assert profiler.status()["requests"] == {}
@@ -0,0 +1,54 @@
+import pytest
+
+from conftest import auth_headers
+from models.sql_models import DBUser
+from sql_metrics import REPEATED_QUERIES_HEADER, assert_query_budget
+
+
+def test_read_current_user_query_budget(client, user):
+    assert_query_budget(client.get("/api/users/me", headers=auth_headers()))
+
+
+def test_update_username_query_budget(client, user):
+    response = client.patch("/api/users/me", json={"username": "alicia"}, headers=auth_headers())
+    assert response.status_code == 200
+    assert response.json()["username"] == "alicia"
+    assert_query_budget(response)
+    assert REPEATED_QUERIES_HEADER not in response.headers
+
+
+def test_update_username_taken(client, user, db_session):
+    db_session.add(DBUser(username="bob", email="bob@example.com", password="x"))
+    db_session.commit()
+
+    response = client.patch("/api/users/me", json={"username": "bob"}, headers=auth_headers())
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Username already taken"
+
+
+def test_change_password_query_budget(client, user):
+    response = client.post(
+        "/api/users/me/password",
+        json={"current_password": "secret", "new_password": "hunter2"},
+        headers=auth_headers(),
+    )
+    assert response.status_code == 200
+    assert_query_budget(response)
+
+
+def test_delete_user_query_budget(client, user):
+    response = client.delete("/api/users/me", headers=auth_headers())
+    assert response.status_code == 200
+    assert_query_budget(response)
+
+
+def test_login_query_budget(client, user):
+    response = client.post("/api/login", data={"username": "alice@example.com", "password": "secret"})
+    assert response.status_code == 200
+    assert_query_budget(response)
+
+
+def test_assert_query_budget_fails_when_exceeded(client, user):
+    response = client.get("/api/users/me", headers=auth_headers())
+    with pytest.raises(AssertionError):
+        assert_query_budget(response, max_queries=0)
@@ -0,0 +1,95 @@
+import os
+import signal
+import time
+
+from shared_state import LOCK_TIMEOUT_SECONDS, SharedTable
+
+
+def test_get_set_pop():
+    table = SharedTable(slots=16, ttl=60)
+    assert table.get("a") is None
+    table.set("a", 5, now=100.0)
+    assert table.get("a", now=101.0) == (5, 100.0)
+    table.pop("a")
+    assert table.get("a", now=101.0) is None
+
+
+def test_entries_expire():
+    table = SharedTable(slots=16, ttl=10)
+    table.set("a", 1, now=100.0)
+    assert table.get("a", now=109.0) is not None
+    assert table.get("a", now=110.0) is None
+
+
+def test_consume_limits_within_window():
+    table = SharedTable(slots=16, ttl=60)
+    results = [table.consume("ip", 2, now=100.0)[0] for _ in range(3)]
+    assert results == [True, True, False]
+    # A new window starts once the old one has expired.
+    assert table.consume("ip", 2, now=160.0) == (True, 160.0)
+
+
+def test_full_table_evicts_oldest():
+    table = SharedTable(slots=8, ttl=60)
+    for i in range(20):
+        table.set(f"k{i}", i, now=100.0 + i)
+    assert table.get("k19", now=120.0) == (19, 119.0)
+
+
+def test_shared_across_fork():
+    table = SharedTable(slots=16, ttl=60)
+    pid = os.fork()
+    if pid == 0:
+        table.consume("ip", 5)
+        table.consume("ip", 5)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    value, _ = table.get("ip")
+    assert value == 2
+
+
+def test_raise_to_never_lowers():
+    table = SharedTable(slots=16, ttl=60)
+    table.raise_to("a", 3, now=100.0)
+    table.raise_to("a", 2, now=101.0)
+    assert table.get("a", now=101.0)[0] == 3
+    table.raise_to("a", 4, now=102.0)
+    assert table.get("a", now=102.0)[0] == 4
+
+
+def _fork_lock_holder(table, then):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        table._lock.acquire(1.0)
+        os.write(write_fd, b"x")
+        then()
+        os._exit(0)
+    os.read(read_fd, 1)
+    os.close(read_fd)
+    os.close(write_fd)
+    return pid
+
+
+def test_lock_released_when_holder_is_killed():
+    table = SharedTable(slots=16, ttl=60)
+    pid = _fork_lock_holder(table, lambda: time.sleep(60))
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+
+    table.set("a", 1)
+    assert table.get("a")[0] == 1
+
+
+def test_fails_open_while_lock_is_held():
+    table = SharedTable(slots=16, ttl=60)
+    table.set("a", 1)
+    pid = _fork_lock_holder(table, lambda: time.sleep(60))
+    try:
+        started = time.monotonic()
+        assert table.get("a") is None
+        assert table.consume("ip", 0)[0] is True
+        assert time.monotonic() - started < 10 * LOCK_TIMEOUT_SECONDS
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)